@@ -10,44 +10,120 @@
 ########################################################################
 
 import os
+import re
+import sys
+import mmap
+import functools
+import itertools
 import subprocess
 import asyncio
+import cs_db
 import cs_environment as env
 from cs_logging import logmsg, logwarning, logerr, print_console_note
 
+# Skip closing every inherited fd (up to `ulimit -n`) in each child between fork and exec.
+# The scripts open no sensitive fds before spawning, and Python creates its own fds non-inheritable.
+# With close_fds=False, subprocess also launches shell=True commands via os.posix_spawn instead of fork+exec
+CS_FAST_SPAWN = True
 
-async def run_command_async(command, results_dict={}):
+# Opened once and reused as stdout/stderr of every discarded-output child, instead of subprocess.DEVNULL per spawn
+_DEVNULL_FD = os.open(os.devnull, os.O_RDWR | os.O_CLOEXEC)
+
+# Production user/machine checks never change for the life of the process, so evaluate them once
+_IS_PROD_USER = env.current_user_is_production()
+_IS_PROD_MACHINE = env.current_machine_is_production_server()
+
+# base_dir -> (directory mtime, list of os.DirEntry); a listing is reused until the directory changes
+_DIR_LISTING_CACHE = {}
+
+# Returned by get_runjob_logfile() in place of a path when the lookup fails
+LOGFILE_RETRIEVAL_ERROR = "<LOGFILE RETRIEVAL ERROR>"
+
+# Set by use_fast_child_watcher(), so the process-wide watcher is only installed once
+_CHILD_WATCHER_INSTALLED = False
+
+# Non-commented CTL line containing "runjob" (leading whitespace not captured)
+_CTL_RUNJOB_RE = re.compile(rb'(?m)^[ \t]*(?=[^#\s])([^\n]*runjob[^\n]*)')
+
+
+async def run_command_async(idx, command):
     """
-    INPUT: Unix command (str), results_dict (dict, optional)
+    INPUT: idx (int) of command, Unix command (str)
            - Not intended for standalone use, only to be called by the next function run_commands_async()
            
-    OUTPUT: command (same as input), failed (bool)
+    OUTPUT: idx (same as input), failed (bool)
     """
-    if command in results_dict:
-        return command, 'SKIPPED'
     logmsg(f"cs_util.py -> Executing command {command} asynchronously...")
     failed = False
     proc = await asyncio.create_subprocess_shell(command,
-                                                stdout=asyncio.subprocess.DEVNULL,
-                                                stderr=asyncio.subprocess.DEVNULL
+                                                stdout=_DEVNULL_FD,
+                                                stderr=_DEVNULL_FD,
+                                                close_fds=not CS_FAST_SPAWN
                                                 )
     await proc.wait()
     if proc.returncode != 0:
         failed = True
         
-    return command, failed
+    return idx, failed
     
 
-async def run_commands_async(commands, results_dict={}):
+def _bounded_command_coros(commands, skipped_mask, max_concurrency):
+    """
+    INPUT: Unix commands (list), skipped_mask (bytearray or None), max_concurrency (int)
+    
+    OUTPUT: list of run_command_async() coroutines, sharing a semaphore so at most max_concurrency run at a time
+            - Commands flagged in skipped_mask are filtered out here, and get no coroutine at all
+    """
+    sem = asyncio.Semaphore(max_concurrency)
+    
+    async def run_bounded(idx, command):
+        async with sem:
+            return await run_command_async(idx, command)
+    
+    return [run_bounded(idx, command) for idx, command in enumerate(commands) if not (skipped_mask and skipped_mask[idx])]
+
+
+async def run_commands_async(commands, skipped_mask=None, max_concurrency=32):
     """
-    INPUT: Unix commands (list), results_dict (dict, optional)
-           - Calls run_command_async() to execute all commands in list input at once
-           - results_dict is only to be used to tell the downstream function whether to skip the command
+    INPUT: Unix commands (list), skipped_mask (bytearray, optional), max_concurrency (int, optional)
+           - Calls run_command_async() to execute all commands in list input, at most max_concurrency at a time
+           - skipped_mask holds one byte per command; nonzero means the command is skipped (not executed)
            
-    OUTPUT: List of (command, failed) tuples, output from run_command_async()
+    OUTPUT: List of (idx, failed) tuples for the executed commands, output from run_command_async()
     """
-    tasks = [run_command_async(command, results_dict) for command in commands]
-    return await asyncio.gather(*tasks)
+    return await asyncio.gather(*_bounded_command_coros(commands, skipped_mask, max_concurrency))
+
+
+def run_commands_as_completed(commands, skipped_mask=None, max_concurrency=32):
+    """
+    INPUT: same as run_commands_async()
+           - Must be called from within a running event loop; all commands are scheduled immediately
+           
+    OUTPUT: iterator of awaitables, each yielding an (idx, failed) tuple for an executed command, in order of completion
+    """
+    tasks = [asyncio.create_task(coro) for coro in _bounded_command_coros(commands, skipped_mask, max_concurrency)]
+    return asyncio.as_completed(tasks)
+
+
+def use_fast_child_watcher():
+    """
+    INPUT: None
+           - Call before asyncio.run(); installs one process-wide child watcher, shared by every event loop
+           - Linux 5.3+: PidfdChildWatcher, reaping each child through its own pidfd instead of a SIGCHLD walk
+           - Older kernels (no pidfd_open): asyncio's default watcher is kept, as it already reaps each child directly
+           - No-op on Python 3.12+ (pidfd is already the default there), or if already installed
+    
+    OUTPUT: None
+    """
+    global _CHILD_WATCHER_INSTALLED
+    if _CHILD_WATCHER_INSTALLED or sys.version_info >= (3, 12):
+        return
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except (AttributeError, OSError):
+        return
+    asyncio.set_child_watcher(asyncio.PidfdChildWatcher())
+    _CHILD_WATCHER_INSTALLED = True
         
 
 def get_unix_command_output(unix_cmd):
@@ -58,7 +134,8 @@ def get_unix_command_output(unix_cmd):
     """
     proc = subprocess.Popen(unix_cmd,
                             stdout=subprocess.PIPE,
-                            shell=True
+                            shell=True,
+                            close_fds=not CS_FAST_SPAWN
                             )
     output, err = proc.communicate()
     
@@ -71,6 +148,35 @@ def get_unix_command_output(unix_cmd):
     return output.decode('utf-8').strip()
 
 
+def _scandir_cached(base_dir):
+    """
+    INPUT: base_dir (str)
+    
+    OUTPUT: list of os.DirEntry for base_dir, reused from _DIR_LISTING_CACHE while the directory's mtime is unchanged
+            - Jobs still running may create new logfiles, so a listing is never trusted past a change to the directory
+    """
+    mtime = os.stat(base_dir).st_mtime_ns
+    cached = _DIR_LISTING_CACHE.get(base_dir)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with os.scandir(base_dir) as it:
+        entries = list(it)
+    _DIR_LISTING_CACHE[base_dir] = (mtime, entries)
+    return entries
+
+
+def clear_path_caches():
+    """
+    INPUT: None
+    
+    OUTPUT: None; drops cached publish_to_runjob() CFG lookups and directory listings
+            - For long-lived callers only, e.g. after publish CFGs were added; a fresh process starts with empty caches
+    """
+    _DIR_LISTING_CACHE.clear()
+    publish_to_runjob.cache_clear()
+
+
+@functools.lru_cache(maxsize=512)
 def publish_to_runjob(publish_cmd):
     """
     INPUT: publish_cmd (str), which is any command such as 'publish RESQ-195'
@@ -78,17 +184,12 @@ def publish_to_runjob(publish_cmd):
     
     OUTPUT: the runjob command corresponding to the input, or None if no CFG was found
     """
-    dir_name = f"{'/NAS/mis/jobs' if env.current_user_is_production() else os.getenv('WORKING_JOBS_DIR')}/all/publish/scpt"
-    pub_name, pub_id = publish_cmd.split()[1].lower().split('-')
-    # Option 1: with hyphen
-    possible_cfg = f"{dir_name}/{pub_name}-{pub_id}_publish.cfg"
-    if os.path.exists(possible_cfg):
-        return f"runjob all_publish {pub_name}-{pub_id}_publish"
-    
-    # Option 2: without hyphen
-    possible_cfg = ''.join(possible_cfg.split('-'))
-    if os.path.exists(possible_cfg):
-        return f"runjob all_publish {pub_name}{pub_id}_publish"
+    dir_name = f"{'/NAS/mis/jobs' if _IS_PROD_USER else os.getenv('WORKING_JOBS_DIR')}/all/publish/scpt"
+    pub_name, pub_id = publish_cmd.split(maxsplit=2)[1].lower().split('-', 1)
+    # Option 1: with hyphen; Option 2: without hyphen
+    for cfg_name in (f"{pub_name}-{pub_id}_publish", f"{pub_name}{pub_id}_publish"):
+        if os.path.exists(f"{dir_name}/{cfg_name}.cfg"):
+            return f"runjob all_publish {cfg_name}"
     # If neither was found, return None
     return
 
@@ -97,7 +198,21 @@ def get_runjob_logfile(runjob_cmd):
     """
     INPUT: runjob_cmd (str), which is any runjob runjob_cmd
     
-    OUTPUT: result (str) of the runjob_cmd
+    OUTPUT: result (str) of the runjob_cmd, or LOGFILE_RETRIEVAL_ERROR (with the error logged)
+    """
+    logfile, err = find_runjob_logfile(runjob_cmd)
+    if err:
+        logerr(f"cs_util.get_runjob_logfile({runjob_cmd}) -> Threw exception:\n{err}")
+        return LOGFILE_RETRIEVAL_ERROR
+    return logfile
+
+
+def find_runjob_logfile(runjob_cmd):
+    """
+    INPUT: runjob_cmd (str), which is any runjob runjob_cmd
+           - Same lookup as get_runjob_logfile(), but writes nothing to the console; safe to run on worker threads
+    
+    OUTPUT: logfile (str) or None, err (Exception) or None
     """
     try:
         # First, check if runjob_cmd starts with "publish ??". In this case, it needs to be translated to "runjob all_publish ??_publish"
@@ -107,33 +222,38 @@ def get_runjob_logfile(runjob_cmd):
                 raise Exception("No CFG file matching the provided report number found")
                 
         # Main code
-        is_srg = (runjob_cmd.split()[1] == "srg")
-        identifier = runjob_cmd.split()[2]
-        is_prod = env.current_machine_is_production_server()
+        parts = runjob_cmd.split()
+        is_srg = (parts[1] == "srg")
+        identifier = parts[2]
+        is_prod = _IS_PROD_MACHINE
         base_dir = "/NAS/mis/" if is_prod else "/NAS/mis/tmp/_"
         base_dir += "srg" if is_srg else "jobs/"
         
         # Prod (CS_PROD=P) vs non-prod distinction in logfile name and/or path
         if is_prod:
             if is_srg:
-                get_srg_name_command = f"ls -d {base_dir}/*/ | grep {identifier}"
-                srg_name = get_unix_command_output(get_srg_name_command).split('/NAS/mis/srg/')[1][:-1]
+                srg_name = next((d.name for d in _scandir_cached(base_dir) if d.is_dir() and identifier in d.name), None)
+                if not srg_name:
+                    raise Exception(f"No SRG directory matching {identifier} found in {base_dir}")
                 # Wrap SRG name in single quotes, as it contains NBSP
-                return f"/NAS/mis/srg/'{srg_name}'/logs/logfile.txt"
+                return f"/NAS/mis/srg/'{srg_name}'/logs/logfile.txt", None
             else:
-                pieces = runjob_cmd.split()[1].split('_')
+                pieces = parts[1].split('_')
                 base_dir += f"{pieces[0]}/{pieces[1]}/log"
         
         else:
             if not is_srg:
-                base_dir += runjob_cmd.split()[1]
+                base_dir += parts[1]
         
-        logfile_command = f"ls -ltr {base_dir}/{identifier}* | tail -1 " + "| awk '{print $NF}'"
-        return get_unix_command_output(logfile_command)
+        # Newest entry matching {base_dir}/{identifier}*, read straight from the directory listing
+        entries = [e for e in _scandir_cached(base_dir) if e.name.startswith(identifier)]
+        if not entries:
+            raise Exception(f"No logfile matching {base_dir}/{identifier}* found")
+        newest = max(entries, key=lambda e: e.stat(follow_symlinks=False).st_mtime)
+        return newest.path, None
     
     except Exception as err:
-        logerr(f"cs_util.get_runjob_logfile({runjob_cmd}) -> Threw exception:\n{err}")
-        return "<LOGFILE RETRIEVAL ERROR>"
+        return None, err
     
 
 def create_directory_if_not_extant(path):
@@ -158,17 +278,19 @@ def check_ctl_for_runjob(command, silent=False):
     else:
         logmsg("cs_util.py -> Parsing CTL for runjob command(s)...")
     runjobs_list = []
-    with open(command) as f:
-        for line in f.readlines():
-            line = line.strip()
-            if "runjob" in line and not line.startswith('#'):
-                logmsg(f"CTL Contains Runjob: {line}")
-                runjobs_list.append(line)
+    with open(command, 'rb') as f:
+        # mmap cannot map an empty file
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as mm:
+                # A 2nd runjob already decides the outcome, so stop scanning there; the rest of the file is never read
+                runjobs_list = [m.group(1).decode().strip() for m in itertools.islice(_CTL_RUNJOB_RE.finditer(mm), 2)]
+    for line in runjobs_list:
+        logmsg(f"CTL Contains Runjob: {line}")
                 
     if len(runjobs_list) == 1:
         return runjobs_list[0]
     if len(runjobs_list) > 1:
-        logwarning(f"CTL contains {len(runjobs_list)} runjobs; executing plain CTL. View log files for each runjob individually.")
+        logwarning("CTL contains multiple runjobs; executing plain CTL. View log files for each runjob individually.")
     return command
 
 
@@ -190,32 +312,55 @@ def get_srg_runjob_command(job_nm):
     params: job_nm (str)
     returns: runjob_cmd (str)
     """
+    return get_srg_runjob_commands_bulk([job_nm]).get(job_nm)
+
+
+def get_srg_runjob_commands_bulk(job_nms):
+    """
+    Given job names (mis_?i??_00_c format), returns SRG runjob commands using a single DB round-trip
+
+    params: job_nms (list of str)
+    returns: runjob_cmds (dict), input job_nm -> runjob_cmd (str); job names without exactly 1 command are omitted
+    """
+    if not job_nms:
+        return {}
     # If job_nm is passed in CTL format, scrub it back to expected format
-    job_nm = f"mis_{job_nm.split('/')[-1].split('praa')[-1].split('.ctl')[0]}_00_c"
+    scrubbed_nms = {job_nm: job_nm if job_nm.startswith('mis_') else f"mis_{job_nm.split('/')[-1].split('praa')[-1].split('.ctl')[0]}_00_c"
+                    for job_nm in job_nms}
+    unique_nms = sorted(set(scrubbed_nms.values()))
     
-    logmsg(f"cs_artifact -> Getting runjob cmd for {job_nm} from MIS_Reports.dbo.ARTFCT_DETAILS_VALUES_T")
+    logmsg(f"cs_util.py -> Getting runjob cmds for {', '.join(unique_nms)} from MIS_Reports.dbo.ARTFCT_DETAILS_VALUES_T")
     
     sql = """
-        SELECT 'runjob srg ' + v.[VALUE] AS 'RUNJOB_CMD'
+        SELECT 'runjob srg ' + v.[VALUE] AS 'RUNJOB_CMD', j.val_255 AS 'JOB_NM'
         FROM   MIS_Reports.dbo.ARTFCT_ATTRB_VALUE_V v
             INNER JOIN MIS_Reports.dbo.ARTFCT_DETAILS_VALUES_T pd ON pd.ARTFCT_ID = v.ARTFCT_ID AND pd.ATTRB_ID = 4
             INNER JOIN MIS_Reports.dbo.ARTFCT_DETAILS_VALUES_T j ON j.ARTFCT_ID = v.ARTFCT_ID AND j.ATTRB_ID = 9
-        WHERE  ARTFCT_TYPE_CD = 'SRG' AND v.ATTRB_ID = 35 AND pd.VAL_255 = 'P' AND j.val_255 = '{}'
-        """.format(job_nm)
+        WHERE  ARTFCT_TYPE_CD = 'SRG' AND v.ATTRB_ID = 35 AND pd.VAL_255 = 'P' AND j.val_255 IN ({})
+        """.format(", ".join("'{}'".format(nm.replace("'", "''")) for nm in unique_nms))
     
     try:
         data = cs_db.DataBase.mssql_query(sql)
-        if len(data) > 1:
-            logwarning(f"cs_artifact -> More than 1 command returned for {job_nm}; check data and retry")
-            return
-        if len(data) < 1:
-            raise Exception f"No command found for '{job_nm}'; either job name \
-                is invalid or data entry is missing"
-            return
-        return data[0].get('RUNJOB_CMD')
     except Exception as e:
-        logerr(f"cs_artifact.get_srg_runjob_command() -> Threw exception:\n{e}")
-        return
+        logerr(f"cs_util.py -> Function 'get_srg_runjob_commands_bulk()' threw exception:\n{e}")
+        return {}
+    
+    # Group returned commands by job name (case- and trailing-space-insensitive, matching the DB comparison)
+    found = {}
+    for row in data:
+        found.setdefault(str(row.get('JOB_NM')).strip().lower(), []).append(row.get('RUNJOB_CMD'))
+    
+    runjob_cmds_by_nm = {}
+    for nm in unique_nms:
+        cmds = found.get(nm.strip().lower(), [])
+        if len(cmds) > 1:
+            logwarning(f"cs_util.py -> More than 1 command returned for {nm}; check data and retry")
+        elif len(cmds) < 1:
+            logerr(f"cs_util.py -> No command found for '{nm}'; either job name is invalid or data entry is missing")
+        else:
+            runjob_cmds_by_nm[nm] = cmds[0]
+    
+    return {job_nm: runjob_cmds_by_nm[nm] for job_nm, nm in scrubbed_nms.items() if nm in runjob_cmds_by_nm}
 
 
 def run_command_python(command, pipe_output=True):
@@ -229,8 +374,9 @@ def run_command_python(command, pipe_output=True):
     failed = False
     proc = subprocess.Popen(command,
                             shell=True,
-                            stdout=(subprocess.PIPE if pipe_output else subprocess.DEVNULL),
-                            stderr=(subprocess.PIPE if pipe_output else subprocess.DEVNULL)
+                            stdout=(subprocess.PIPE if pipe_output else _DEVNULL_FD),
+                            stderr=(subprocess.PIPE if pipe_output else _DEVNULL_FD),
+                            close_fds=not CS_FAST_SPAWN
                             )
     proc.wait()
     if proc.returncode != 0:
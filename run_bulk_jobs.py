@@ -2,29 +2,42 @@
 # Name:     run_bulk_jobs.py
 # Author:   Jeremy Ulfohn
 # Date:     3 June 2024
-# Purpose:  Takes .txt file as input and runs all jobs in the file synchronously
-#           Creates dict to track failures, and provides log to each failure when the script concludes
+# Purpose:  Takes .txt file as input and runs all jobs in the file asynchronously
+#           Reports each job's result as it finishes, tracking statuses in parallel commands/statuses arrays,
+#           and provides log to each failure in a results overview when the script concludes
 ########################################################################
 import os
+import re
 import sys
 import argparse
 import asyncio
+import concurrent.futures
 
 import cs_util
 import cs_environment as env
-from cs_artifact import get_srg_runjob_command
 from cs_logging import logmsg, logerr, logheader, logwarning, logsuccess, print_console_note
 
 sys.dont_write_bytecode = True
 script_arrow = str(os.path.basename(__file__)) + " -> "
 
+# SRG jobs have 'i' as the 2nd letter of the job code, e.g. /NAS/mis/esp/scripts/praa1i23.ctl
+_SRG_RE = re.compile(r'/NAS/mis/esp/scripts/praa.i')
 
-def scrub_line(line):
+# Commands that write a logfile (see has_logfile())
+_HAS_LOG_PREFIXES = ("runjob ", "publish ")
+
+# Per-command status codes, stored one byte per command in statuses[] (0 until the command is reported)
+SUCCESS, FAILURE, SKIPPED, LONGRUN = range(1, 5)
+
+# Persistent pool for blocking NAS lookups (threads are only started as work is submitted)
+_IO_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=32)
+
+
+def to_ctl_path(line):
     """
-    Purpose: Scrubs input into valid CTL path, and checks if job is SRG
-    Returns: scrubbed_line (str), skip_ctl (boolean)
+    Purpose: Scrubs input into valid CTL path, where the input refers to a CTL
+    Returns: scrubbed_line (str)
     """
-    original_line = line
     # Option 1. Job code only
     if len(line) == 4 and line.isalnum():
         line = f"praa{line}.ctl"
@@ -32,29 +45,103 @@ def scrub_line(line):
     line = line.replace("./", "")
     if line.startswith("praa"):
         line = "/NAS/mis/esp/scripts/" + line + ("" if line.endswith('.ctl') else ".ctl")
+    return line
+
+
+def is_srg_ctl(line):
+    """
+    Purpose: Checks if a scrubbed line is an SRG CTL (i.e. 2nd letter of job name is 'i'), which will not exist
+    Returns: is_srg (bool)
+    """
+    return ".ctl" in line and bool(_SRG_RE.search(line))
+
+
+def scrub_line(line, ctl_path, is_srg, srg_commands):
+    """
+    Purpose: Finalizes scrubbed input (ctl_path and is_srg, as returned by to_ctl_path(line) and is_srg_ctl(ctl_path))
+             srg_commands maps SRG CTL paths to their runjob cmd, as fetched by cs_util.get_srg_runjob_commands_bulk()
+    Returns: scrubbed_line (str), skip_ctl (boolean)
+    """
+    original_line = line
+    line = ctl_path
         
-    # Check job name for SRG (i.e. 2nd letter is 'i'). In this case, the CTL file will not exist, so query DB for runjob cmd
-    if ".ctl" in line:
-        if line.split('/NAS/mis/esp/scripts/praa')[1][1] == "i":
-            logwarning(script_arrow + f"{original_line} is an SRG; {line} will not exist")
-            # If runjob command is found, replace CTL with the valid runjob. Else, skip it
-            line = get_srg_runjob_command(line)
-            if not line:
-                return original_line, True
+    # Check job name for SRG. In this case, the CTL file will not exist, so use the runjob cmd from the DB
+    if is_srg:
+        logwarning(script_arrow + f"{original_line} is an SRG; {line} will not exist")
+        # If runjob command is found, replace CTL with the valid runjob. Else, skip it
+        line = srg_commands.get(line)
+        if not line:
+            return original_line, True
     
     if original_line != line:
         logmsg(script_arrow + f"Scrubbed {original_line} to {line}")
     return line, False
 
 
+def print_logfile(command, logfile_future):
+    """
+    Purpose: Prints the logfile of a failed command, as resolved on _IO_POOL by cs_util.find_runjob_logfile()
+             Any lookup error is logged here, next to the job it belongs to
+    Returns: None
+    """
+    logfile, err = logfile_future.result()
+    if err:
+        logerr(f"cs_util.get_runjob_logfile({command}) -> Threw exception:\n{err}")
+        logfile = cs_util.LOGFILE_RETRIEVAL_ERROR
+    print_console_note("Logfile available at: " + logfile)
+
+
 def has_logfile(command):
     """
     Purpose: Checks if a command is of type "runjob" or "publish", in which case it has a logfile
     Returns: has_logfile (bool)
     """
-    if any(script in command for script in ["runjob", "publish"]):
-        return True
-    return False
+    return command.startswith(_HAS_LOG_PREFIXES)
+    
+
+async def run_and_report(commands, skipped_mask, statuses):
+    """
+    Purpose: Executes commands asynchronously, reporting each result as soon as it completes
+             Logfile lookups for failures are started on _IO_POOL while the remaining commands still run
+    Returns: failure_count (int), skipped_count (int), logfiles (dict of index -> Future of (logfile, err))
+    """
+    total_lines = len(commands)
+    failure_count = skipped_count = done = 0
+    logfiles = {}
+    
+    # Skipped commands are never executed, so report them up front
+    for ind, skip in enumerate(skipped_mask):
+        if skip:
+            done += 1
+            logwarning(f"(#{ind+1}/{total_lines}) {commands[ind]} skipped", skip_format=True)
+            statuses[ind] = SKIPPED
+            skipped_count += 1
+            print("#" * 96, end='\n' if (done < total_lines) else '\n\n')
+    
+    for result in cs_util.run_commands_as_completed(commands, skipped_mask):
+        done += 1
+        ind, failed = await result
+        command = commands[ind]
+        if failed is None:
+            logerr(f"(#{ind+1}/{total_lines}) {command} ran long and did not reach endstate", skip_format=True)
+            statuses[ind] = LONGRUN
+            failure_count += 1
+        elif failed:
+            logerr(f"(#{ind+1}/{total_lines}) {command} failed", skip_format=True)
+            statuses[ind] = FAILURE
+            failure_count += 1
+        else:
+            logsuccess(f"(#{ind+1}/{total_lines}) {command} completed!", skip_format=True)
+            statuses[ind] = SUCCESS
+        
+        if statuses[ind] in (LONGRUN, FAILURE) and has_logfile(command):
+            # The lookup logs nothing itself, so worker threads never write into the streamed results
+            logfiles[ind] = _IO_POOL.submit(cs_util.find_runjob_logfile, command)
+                   
+        # Print separator line after each result
+        print("#" * 96, end='\n' if (done < total_lines) else '\n\n')
+    
+    return failure_count, skipped_count, logfiles
     
 
 # Acceptable inputs: /NAS/mis/esp/scripts/praa1234.ctl == praa1234.ctl == 1234
@@ -76,44 +163,39 @@ if __name__ == '__main__':
     if len(sys.argv) == 3:
         os.environ['WORKING_JIRA_ID'] = sys.argv[2]
         
+    # Install the child watcher before any event loop exists, so every subprocess is reaped through it
+    cs_util.use_fast_child_watcher()
     logheader(script_arrow + "Execution begins")
     print("-" * 96)
-    results_dict = {}
-    failure_count = skipped_count = 0
-    with open(input_filename) as f:
-        # Filter list to exclude commented or empty lines
-        lines = list(filter(cs_util.check_valid_line, f.readlines()))
+    with open(input_filename, 'rb') as f:
+        data = f.read().splitlines()
+    # Filter list to exclude commented or empty lines (same rules as cs_util.check_valid_line); only survivors are decoded
+    lines = [l.decode().strip() for l in data if l.strip() and not l.startswith((b'#', b'//'))]
         
     total_lines = len(lines)
     
-    # Scrub line for proper formatting, modifying lines[] accordingly
-    for ind in range(total_lines):
-        lines[ind], skip_ctl = scrub_line(lines[ind].strip())
-        if skip_ctl:
-            results_dict[lines[ind]] = "SKIPPED"
-            continue
-    
-    # Execute each valid command in lines[] asynchronously
-    result_tuples = asyncio.run(cs_util.run_commands_async(lines, results_dict=results_dict))
+    # Scrub line for proper formatting into commands[], flagging skipped ones in skipped_mask[]
+    ctl_paths = list(map(to_ctl_path, lines))
+    srg_flags = list(map(is_srg_ctl, ctl_paths))
+    skipped_mask = bytearray(total_lines)
+    if not any(srg_flags):
+        # Fast lane (common case): without SRGs nothing can be skipped, so the scrubbed paths are the final commands
+        commands = ctl_paths
+        for line, command in zip(lines, commands):
+            if line != command:
+                logmsg(script_arrow + f"Scrubbed {line} to {command}")
+    else:
+        # SRG CTLs do not exist, so fetch the runjob cmds for every SRG in the file with one DB query
+        srg_commands = cs_util.get_srg_runjob_commands_bulk([ctl for ctl, is_srg in zip(ctl_paths, srg_flags) if is_srg])
+        commands = []
+        for ind, line in enumerate(lines):
+            command, skip_ctl = scrub_line(line, ctl_paths[ind], srg_flags[ind], srg_commands)
+            commands.append(command)
+            skipped_mask[ind] = skip_ctl
     
-    for ind, (command, failed) in enumerate(result_tuples):
-        if failed is None:
-            logerr(f"(#{ind+1}/{total_lines}) {command} ran long and did not reach endstate", skip_format=True)
-            results_dict[command] = "LONGRUN"
-            failure_count += 1
-        elif failed == 'SKIPPED':
-            logwarning(f"(#{ind+1}/{total_lines}) {command} skipped", skip_format=True)
-            skipped_count += 1
-        elif failed:
-            logerr(f"(#{ind+1}/{total_lines}) {command} failed", skip_format=True)
-            results_dict[command] = "FAILURE"
-            failure_count += 1
-        else:
-            logsuccess(f"(#{ind+1}/{total_lines}) {command} completed!", skip_format=True)
-            results_dict[command] = "SUCCESS"
-                   
-        # Print separator line after each result
-        print("#" * 96, end='\n' if (ind+1 < total_lines) else '\n\n')
+    # Execute each valid command in commands[] asynchronously, reporting results as they complete
+    statuses = bytearray(total_lines)
+    failure_count, skipped_count, logfiles = asyncio.run(run_and_report(commands, skipped_mask, statuses))
 
     ###############################
     #    RESULTS OVERVIEW CODE    #
@@ -127,24 +209,23 @@ if __name__ == '__main__':
     # 2. Failures/long runs. Display results to user, along with logfiles where applicable
     if failure_count > 0:
         logerr(script_arrow + f"Experienced {failure_count} failures. Listed below:", skip_format=True)
-        for ind, k in enumerate(results_dict):
-            v = results_dict[k]
+        for ind, st in enumerate(statuses):
+            k = commands[ind]
             
-            if v == "LONGRUN":
+            if st == LONGRUN:
                 logmsg(f"(#{ind+1}) Job {k} ran long or did not reach end state")
-                if has_logfile(k):
-                    print_console_note("Logfile available at: " + cs_util.get_runjob_logfile(k))             
-            elif v == "FAILURE":
+                if ind in logfiles:
+                    print_logfile(k, logfiles[ind])
+            elif st == FAILURE:
                 logmsg(f"(#{ind+1}) Job {k} failed")
-                if has_logfile(k):
-                    print_console_note("Logfile available at: " + cs_util.get_runjob_logfile(k))           
-            elif v == "SKIPPED":
+                if ind in logfiles:
+                    print_logfile(k, logfiles[ind])
+            elif st == SKIPPED:
                 logmsg(f"(#{ind+1}) Job {k} skipped. Check that associated SRG exists and retry")
                 
     # 3. Full success
     else:
         logsuccess(script_arrow + "No failures detected!")
     
+    _IO_POOL.shutdown()
     logmsg(script_arrow + "Execution ends")
-run_bulk_jobs.txt
-Displaying run_bulk_jobs.txt.